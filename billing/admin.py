@@ -1,5 +1,4 @@
 from datetime import timedelta
-import json
 from django.utils import timezone
 from django.utils.html import format_html
 from django.contrib import admin
@@ -73,24 +72,23 @@ class StripeEventAdmin(admin.ModelAdmin):
 
     def subscription_status(self, obj):
         if obj.payload_type.startswith("customer.subscription."):
-            payload = json.loads(obj.body)
-            return payload["data"]["object"]["status"]
+            return obj.payload["data"]["object"]["status"]
 
     @admin.action(description="Replay event")
     def replay_event(self, request, queryset):
 
         for obj in queryset.all():
-            payload = json.loads(obj.body)
             event = models.StripeEvent.objects.create(
                 event_id=obj.event_id,
-                payload_type=payload["type"],
+                payload_type=obj.payload["type"],
                 headers=obj.headers,
                 body=obj.body,
                 created=obj.created,
+                user_id=obj.user_id,
                 status=models.StripeEvent.Status.NEW,
                 note=f"Replay of event pk {obj.id}",
             )
-            if hasattr(tasks, "shared_task"):
+            if tasks.HAS_CELERY:
                 tasks.process_stripe_event.apply(
                     kwargs={
                         "event_id": event.id,
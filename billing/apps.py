@@ -9,15 +9,16 @@ class BillingConfig(AppConfig):
     def ready(self):
         import billing.signals
 
-        for setting in (
-            "STRIPE_API_KEY",
-            "APPLICATION_NAME",
-            "CHECKOUT_SUCCESS_URL",
-            "CHECKOUT_CANCEL_URL",
-        ):
-            missing = []
-            if getattr(settings, setting) is None:
-                missing.append(setting)
-            if len(missing) > 0:
-                missing = ", ".join(missing)
-                raise ImproperlyConfigured(f"{missing} must be configured.")
+        missing = [
+            setting
+            for setting in (
+                "STRIPE_API_KEY",
+                "APPLICATION_NAME",
+                "CHECKOUT_SUCCESS_URL",
+                "CHECKOUT_CANCEL_URL",
+            )
+            if getattr(settings, setting) is None
+        ]
+        if missing:
+            missing = ", ".join(missing)
+            raise ImproperlyConfigured(f"{missing} must be configured.")
@@ -1,4 +1,4 @@
-from django.contrib.auth import get_user_model
+from django.conf import settings
 from django.utils import timezone
 import factory
 import factory.random
@@ -8,7 +8,6 @@ from . import models
 
 factory.random.reseed_random(42)
 
-User = get_user_model()
 fake = faker.Faker()  # This is to use faker without the factory_boy wrapper
 
 
@@ -73,7 +72,7 @@ class StripeSubscriptionFactory(factory.django.DjangoModelFactory):
 
 class UserFactory(factory.django.DjangoModelFactory):
     class Meta:
-        model = User
+        model = settings.AUTH_USER_MODEL
 
     first_name = factory.Faker("first_name")
     last_name = factory.Faker("last_name")
@@ -97,7 +96,8 @@ class UserFactory(factory.django.DjangoModelFactory):
         if extracted:
             StripeSubscriptionFactory(customer=obj.customer)
             obj.customer.customer_id = fake.pystr()
-            obj.customer.save()
+            # The subscription sync already wrote the plan and current_period_end.
+            obj.customer.save(update_fields=["customer_id"])
 
     # If we pass in deep attributes to customer, this sets them properly.
     # Since it's defined after `paying`, it will overwrite that trait.
@@ -107,6 +107,8 @@ class UserFactory(factory.django.DjangoModelFactory):
             not create
         ):  # This is the factoryboy "strategy": build vs create. This is incompatible with build.
             return
+        if not kwargs:
+            return
         for k, v in kwargs.items():
             setattr(obj.customer, k, v)
         obj.customer.save()
@@ -0,0 +1,21 @@
+# Generated by Django 4.1.13 on 2026-10-15 21:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("billing", "0005_stripeevent_created"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="stripeevent",
+            index=models.Index(
+                condition=models.Q(("status__in", ["new", "pending"])),
+                fields=["created"],
+                name="stripeevent_pending_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.13 on 2026-10-15 21:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("billing", "0006_stripeevent_pending_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="stripeevent",
+            index=models.Index(
+                fields=["user", "created"], name="stripeevent_user_created_idx"
+            ),
+        ),
+    ]
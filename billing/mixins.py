@@ -2,54 +2,60 @@ from django.urls import reverse
 from django.utils import timezone
 from . import models
 
+# Notes shown for each Customer.state. {current_period_end} is filled in when rendered.
+_SUPPORT_NOTE = "There is an issue with your subscription. Please contact support."
+_CARD_NOTE = (
+    "There is a problem with your credit card. Please provide a new one or try again."
+)
+_STATE_NOTES = {
+    "free_default.new": "",
+    "free_default.canceled.missed_webhook": _SUPPORT_NOTE,
+    "paid.paying": "Subscription renews on {current_period_end}.",
+    "paid.will_cancel": "Subscription cancelled. Access available until {current_period_end}.",
+    "free_private.indefinite": "Staff plan, no expiration.",
+    "free_private.will_expire": "Staff plan expires on {current_period_end}.",
+    "free_private.expired": "Subscription expired on {current_period_end}",
+    "free_default.past_due.requires_payment_method": _CARD_NOTE,
+    "free_default.incomplete.requires_payment_method": _CARD_NOTE,
+    "paid.past_due.requires_payment_method": _CARD_NOTE,
+}
+
 
 class BillingMixin:
     @staticmethod
-    def state_note(customer):
-        """Convenience to avoid doing lots of logic in the template"""
+    def state_note(customer, state=None):
+        """Convenience to avoid doing lots of logic in the template. Pass the state if
+        it's already been computed for this customer."""
+        if state is None:
+            state = customer.state
+        note = _STATE_NOTES.get(state, _SUPPORT_NOTE)
         current_period_end = ""
         if customer.current_period_end:
             current_period_end = timezone.localtime(
                 customer.current_period_end
             ).strftime("%b %d, %Y")
-
-        if customer.state == "free_default.new":
-            return ""
-        elif customer.state == "free_default.canceled.missed_webhook":
-            return "There is an issue with your subscription. Please contact support."
-        elif customer.state == "paid.paying":
-            return f"Subscription renews on {current_period_end}."
-        elif customer.state == "paid.will_cancel":
-            return (
-                f"Subscription cancelled. Access available until {current_period_end}."
-            )
-        elif customer.state == "free_private.indefinite":
-            return f"Staff plan, no expiration."
-        elif customer.state == "free_private.will_expire":
-            return f"Staff plan expires on {current_period_end}."
-        elif customer.state == "free_private.expired":
-            return f"Subscription expired on {current_period_end}"
-        elif customer.state in (
-            "free_default.past_due.requires_payment_method",
-            "free_default.incomplete.requires_payment_method",
-            "paid.past_due.requires_payment_method",
-        ):
-            return "There is a problem with your credit card. Please provide a new one or try again."
-        else:
-            return "There is an issue with your subscription. Please contact support."
+        return note.format(current_period_end=current_period_end)
 
     def get_context_data(self, **kwargs):
         ctx = {"billing_enabled": True}
-        customer = self.request.user.customer
+        # Customer.state looks at the plan and subscriptions many times, so load them up front.
+        customer = (
+            models.Customer.objects.select_related("plan")
+            .prefetch_related("stripesubscription_set")
+            .get(user=self.request.user)
+        )
         state = customer.state
 
         if state in (
             "free_default.new",
             "free_private.expired",
         ):
-            paid_plan = models.Plan.objects.filter(
-                type=models.Plan.Type.PAID_PUBLIC
-            ).first()
+            # Only the slug, which comes from the name, is needed for the URL.
+            paid_plan = (
+                models.Plan.objects.filter(type=models.Plan.Type.PAID_PUBLIC)
+                .only("name")
+                .first()
+            )
             ctx["stripe_session_url"] = reverse(
                 "billing:create_checkout_session",
                 kwargs={"slug": paid_plan.slug, "pk": paid_plan.pk},
@@ -72,6 +78,6 @@ class BillingMixin:
             ctx["stripe_session_url"] = reverse("billing:create_portal_session")
             ctx["stripe_session_button_text"] = "Reactivate Paid Plan"
             ctx["stripe_session_type"] = "portal"
-        ctx["billing_state_note"] = self.state_note(customer)
+        ctx["billing_state_note"] = self.state_note(customer, state)
         ctx["current_plan"] = customer.plan
         return ctx
@@ -1,9 +1,11 @@
+import json
 import logging
 from django.conf import settings
 from django.db import models
 from django.db.models import CheckConstraint, Q, UniqueConstraint
 from django.core.exceptions import ValidationError
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.text import slugify
 
 from . import services
@@ -146,7 +148,6 @@ class Customer(models.Model):
         logger.info(
             f"User.id={self.user.id} canceling subscription_id {self.subscription.id}"
         )
-        self.save()
         return services.stripe_cancel_subscription(self.subscription.id, immediate)
 
     @property
@@ -158,14 +159,17 @@ class Customer(models.Model):
         # We have to check if they're on a paid plan since a deleted subscription is still
         # needed for sync_to_customer. But once the Customer is synced (and back on a free_default plan)
         # is there, it's easiest to pretend the StripeSubscription just doesn't exist anymore.
-        subscriptions = self.stripesubscription_set.order_by("-created")
+        # Sorting and filtering happen in Python so that subscriptions loaded with
+        # prefetch_related("stripesubscription_set") are used without another query.
+        subscriptions = sorted(
+            self.stripesubscription_set.all(), key=lambda s: s.created, reverse=True
+        )
         if self.plan.type not in (Plan.Type.PAID_PUBLIC, Plan.Type.PAID_PRIVATE):
-            subscriptions = subscriptions.exclude(
-                status__in=[
-                    StripeSubscription.Status.CANCELED,
-                    StripeSubscription.Status.INCOMPLETE_EXPIRED,
-                ]
+            deleted = (
+                StripeSubscription.Status.CANCELED,
+                StripeSubscription.Status.INCOMPLETE_EXPIRED,
             )
+            subscriptions = [s for s in subscriptions if s.status not in deleted]
 
         # We prefer an active subscription to a past_due subscription to every other subscription.
         # If there are still multiple subscriptions after that heuristic, we take the most recently created one.
@@ -316,7 +320,15 @@ class Customer(models.Model):
             # and free_private plans without current_period_end exist indefinitely.
             plan = Plan.objects.get(type=Plan.Type.FREE_DEFAULT)
 
-        limit = plan.planlimit_set.filter(limit__name=name).first()
+        planlimits = getattr(plan, "_prefetched_objects_cache", {}).get("planlimit_set")
+        if planlimits is not None and all(
+            PlanLimit.limit.is_cached(pl) for pl in planlimits
+        ):
+            # Use PlanLimits loaded with prefetch_related("plan__planlimit_set__limit").
+            # Without their Limits, reading each name would be a query per PlanLimit.
+            limit = next((pl for pl in planlimits if pl.limit.name == name), None)
+        else:
+            limit = plan.planlimit_set.filter(limit__name=name).first()
         if limit:
             return limit.value
         else:
@@ -351,37 +363,52 @@ class StripeSubscription(models.Model):
     def sync_to_customer(self):
         """Synchronizes data on the StripeSubscription instance to the Customer instance,
         if and as appropriate."""
-        logger.debug(
-            f"StripeSubscription.id={self.id} StripeSubscription.status={self.status} running sync_to_customer"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"StripeSubscription.id={self.id} StripeSubscription.status={self.status} running sync_to_customer"
+            )
 
         # Sync the plan and end date if the subscription is active.
         if self.status == StripeSubscription.Status.ACTIVE:
             plan = Plan.objects.get(price_id=self.price_id)
-            self.customer.plan = plan
-            self.customer.current_period_end = self.current_period_end
-            self.customer.save()
-            logger.debug(
-                f"StripeSubscription.id={self.id} updated customer {self.customer} which is user {self.customer.user.pk} plan to {self.customer.plan} and current_period_end to {self.customer.current_period_end}"
-            )
+            current_period_end = self.current_period_end
 
         # If the subscription is finally deleted, downgrade the customer to free_default and
         # zero-out the current_period_end.
-        if self.status in (
+        elif self.status in (
             StripeSubscription.Status.CANCELED,
             StripeSubscription.Status.INCOMPLETE_EXPIRED,
         ):
             plan = Plan.objects.get(type=Plan.Type.FREE_DEFAULT)
-            self.customer.plan = plan
-            self.customer.current_period_end = None
-            self.customer.save()
+            current_period_end = None
 
         # Do the same thing if its incomplete, but just for consistency's sake.
-        if self.status == StripeSubscription.Status.INCOMPLETE:
+        elif self.status == StripeSubscription.Status.INCOMPLETE:
             plan = Plan.objects.get(type=Plan.Type.FREE_DEFAULT)
+            current_period_end = None
+
+        else:
+            return
+
+        # Write only these two columns in a single UPDATE rather than saving the whole Customer.
+        updated = Customer.objects.filter(pk=self.customer_id).update(
+            plan=plan, current_period_end=current_period_end
+        )
+        if updated == 0:
+            logger.warning(
+                f"StripeSubscription.id={self.id} has no Customer to sync to."
+            )
+            return
+
+        # Keep an already loaded Customer consistent with the database so a later save()
+        # doesn't write back stale values.
+        if StripeSubscription.customer.is_cached(self):
             self.customer.plan = plan
-            self.customer.current_period_end = None
-            self.customer.save()
+            self.customer.current_period_end = current_period_end
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"StripeSubscription.id={self.id} updated Customer.id={self.customer_id} plan to {plan} and current_period_end to {current_period_end}"
+            )
 
     def __str__(self):
         return self.id
@@ -418,5 +445,24 @@ class StripeEvent(models.Model):
         max_length=127, choices=Status.choices, default=Status.NEW
     )
 
+    class Meta:
+        indexes = [
+            # Supports the scan for unprocessed events in process_new_stripe_events.
+            models.Index(
+                fields=["created"],
+                condition=Q(status__in=["new", "pending"]),
+                name="stripeevent_pending_idx",
+            ),
+            # Supports the out of order check, which looks for a User's later events.
+            models.Index(
+                fields=["user", "created"], name="stripeevent_user_created_idx"
+            ),
+        ]
+
+    @cached_property
+    def payload(self):
+        """The parsed body, decoded once per instance."""
+        return json.loads(self.body)
+
     def __str__(self):
         return self.event_id
@@ -1,7 +1,10 @@
 import logging
+from datetime import timedelta
 from unittest import mock
 
 import stripe
+from django.utils import timezone
+
 from . import settings
 
 stripe.api_key = settings.STRIPE_API_KEY
@@ -61,23 +64,14 @@ def stripe_modify_customer(customer_id, **kwargs):
     return customer
 
 
-def stripe_retry_latest_invoice(customer_id):
+def stripe_retry_latest_invoice(customer_id, idempotency_key=None):
+    """Pay the customer's latest invoice if it's open. Pass an idempotency_key so a
+    repeated call for the same cause doesn't attempt payment again."""
     if settings.STRIPE_API_KEY == "mock":
-        from . import factories
-
+        period_end = timezone.now() + timedelta(days=30)
         return {
             "status": "paid",
-            "lines": {
-                "data": [
-                    {
-                        "period": {
-                            "end": factories.fake.future_datetime(
-                                end_date="+30d"
-                            ).timestamp()
-                        }
-                    }
-                ]
-            },
+            "lines": {"data": [{"period": {"end": period_end.timestamp()}}]},
         }
 
     invoice_list = stripe.Invoice.list(customer=customer_id, limit=1)["data"]
@@ -98,7 +92,7 @@ def stripe_retry_latest_invoice(customer_id):
         )
         return None
 
-    invoice = stripe.Invoice.pay(invoice["id"])
+    invoice = stripe.Invoice.pay(invoice["id"], idempotency_key=idempotency_key)
     return invoice
 
 
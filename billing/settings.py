@@ -6,3 +6,4 @@ CHECKOUT_SUCCESS_URL = getattr(settings, "BILLING_CHECKOUT_SUCCESS_URL", None)
 CHECKOUT_CANCEL_URL = getattr(settings, "BILLING_CHECKOUT_CANCEL_URL", None)
 PORTAL_RETURN_URL = getattr(settings, "BILLING_PORTAL_RETURN_URL", None)
 STRIPE_WH_SECRET = getattr(settings, "BILLING_STRIPE_WH_SECRET", None)
+EVENT_BATCH_PROCESSING = getattr(settings, "BILLING_EVENT_BATCH_PROCESSING", False)
@@ -13,17 +13,34 @@ CANCELABLE_STATES = (
     "paid.past_due.requires_payment_method",
 )
 
+STRIPE_USER_FIELDS = frozenset(("first_name", "last_name", "email"))
+
 
 @receiver(pre_save, sender=settings.AUTH_USER_MODEL)
 def user_pre_save_signal(sender, instance, **kwargs):
     """If a User's name or email is changed, update it in Stripe."""
+    # Saves limited to other fields, e.g., last_login on every login, can't change them.
+    update_fields = kwargs.get("update_fields")
+    if update_fields is not None and not STRIPE_USER_FIELDS & update_fields:
+        return
+    User = get_user_model()
+    if instance.pk is not None and not User.customer.is_cached(instance):
+        # Load the Customer with its Plan in one query. The post_save signal reuses it.
+        customer = (
+            models.Customer.objects.select_related("plan")
+            .filter(user_id=instance.pk)
+            .first()
+        )
+        if customer is not None:
+            instance.customer = customer
     if hasattr(instance, "customer") and instance.customer.customer_id:
-        User = get_user_model()
-        orig = User.objects.get(pk=instance.pk)
+        orig = User.objects.values("first_name", "last_name", "email").get(
+            pk=instance.pk
+        )
         if (
-            orig.first_name != instance.first_name
-            or orig.last_name != instance.last_name
-            or orig.email != instance.email
+            orig["first_name"] != instance.first_name
+            or orig["last_name"] != instance.last_name
+            or orig["email"] != instance.email
         ):
             name = f"{instance.first_name} {instance.last_name}"
             services.stripe_modify_customer(
@@ -43,6 +60,8 @@ def user_post_save_signal(sender, instance, **kwargs):
             defaults={"name": "Default (Free)", "display_price": 0},
         )
         models.Customer.objects.create(user=instance, plan=default_plan)
+        # A new Customer was just written and has no subscription to cancel.
+        return
     if not instance.is_active and instance.customer.state in CANCELABLE_STATES:
         # Cancel Stripe subscription immediately if the user is being soft deleted.
         # Clears all Customer-related info (other than Stripe customer_id)
@@ -1,180 +1,293 @@
-import json
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta, timezone
 import logging
-from re import T
-import traceback
 import stripe
 
-from django.utils import timezone
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
 
 from . import models, settings, services
 
+# Celery is optional. Without it, tasks are plain functions that run synchronously.
 try:
+    from celery import shared_task
     from celery.utils.log import get_task_logger
 
+    HAS_CELERY = True
     logger = get_task_logger(__name__)
 except ImportError:
+    HAS_CELERY = False
     logger = logging.getLogger(__name__)
 
+    def shared_task(func):
+        return func
+
+
+_ES = models.StripeEvent.Status
+_SS = models.StripeSubscription.Status
+_TERMINAL = (_ES.PROCESSED, _ES.IGNORED, _ES.ERROR)
+_EPOCH = dt(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _from_timestamp(timestamp):
+    """Convert a Stripe Unix timestamp to an aware UTC datetime without going through
+    the local time conversion in datetime.fromtimestamp."""
+    return _EPOCH + timedelta(seconds=timestamp)
+
 
 def link_user_to_event(event, customer_id):
     """When an event comes in, try to match on the customer_id. If it can't, try to
-    match on the email."""
+    match on the email. An event that is already linked to a User, e.g., a replay, uses
+    that User's Customer if it matches."""
 
-    customer = models.Customer.objects.filter(customer_id=customer_id).first()
+    customer = None
+    if event.user_id:
+        customer = getattr(event.user, "customer", None)
+        if customer and customer.customer_id not in (None, customer_id):
+            customer = None
+    if not customer:
+        customer = models.Customer.objects.filter(customer_id=customer_id).first()
     if not customer:
         # Couldn't find the user via customer_id, so try matching on email.
         stripe_customer = stripe.Customer.retrieve(customer_id)
         customer = models.Customer.objects.get(user__email=stripe_customer.email)
 
-    event.user = customer.user
-    event.save()
+    if event.user_id != customer.user_id:
+        event.user_id = customer.user_id
+        event.save(update_fields=["user"])
 
     # Set customer_id if not already set.
     if not customer.customer_id:
         customer.customer_id = customer_id
-        customer.save()
+        customer.save(update_fields=["customer_id"])
 
     return customer
 
 
+def _link_event(event, payload):
+    """Link the Customer in an event payload to the event. Returns None if there is no
+    matching Customer."""
+    try:
+        return link_user_to_event(event, payload["data"]["object"]["customer"])
+    except models.Customer.DoesNotExist:
+        return None
+
+
+def _handle_subscription_event(event, payload, customer, check_created):
+    """Create or update the StripeSubscription in a customer.subscription.* event and
+    sync it to the Customer. Returns the resulting StripeEvent status."""
+    data_object = payload["data"]["object"]
+
+    # Extract the relevant attributes from the event payload
+    id = data_object["id"]
+    customer_id = data_object["customer"]
+    current_period_end = data_object["current_period_end"]
+    price_id = data_object["items"]["data"][0]["price"]["id"]
+    cancel_at_period_end = data_object["cancel_at_period_end"]
+    created = data_object["created"]
+    status = data_object["status"]
+
+    if customer is None:
+        # If a user is being hard deleted so the subscription is immediately canceled,
+        # this will happen, so we need to be ok with a user not existing in that case.
+        if status == "canceled":
+            logger.warning(
+                "StripeEvent.id=%s could not locate a user who may have been hard deleted.",
+                event.id,
+            )
+            return _ES.PROCESSED
+        else:
+            raise models.Customer.DoesNotExist(
+                f"No Customer matches customer_id={customer_id}"
+            )
+
+    # Ensure this Event is the latest one, i.e., Events haven't
+    # arrived out of order.
+    if check_created and (
+        models.StripeEvent.objects.filter(
+            user_id=customer.user_id, created__gte=event.created
+        )
+        .exclude(pk=event.id)
+        .exists()
+    ):
+        logger.warning("StripeEvent.id=%s processed out of order. Ignoring.", event.id)
+        return _ES.IGNORED
+
+    # Create or update StripeSubscription
+    subscription = models.StripeSubscription.objects.filter(id=id).first()
+    if not subscription:
+        logger.info(
+            "StripeEvent.id=%s no StripeSubscription found, creating.", event.id
+        )
+        subscription = models.StripeSubscription(id=id)
+
+    subscription.current_period_end = _from_timestamp(current_period_end)
+    subscription.price_id = price_id
+    subscription.cancel_at_period_end = cancel_at_period_end
+    subscription.created = _from_timestamp(created)
+    subscription.status = status
+    subscription.save()
+
+    # Link Customer/User to StripeSubscription
+    if not subscription.customer_id:
+        logger.info(
+            "StripeEvent.id=%s no customer attached to StripeSubscription, attaching to %s.",
+            event.id,
+            customer,
+        )
+        subscription.customer = customer
+        subscription.save(update_fields=["customer"])
+    else:
+        # Integrity check: if the StripeSubscription already has a customer, it should match
+        # the incoming subscription update.
+        assert (
+            subscription.customer_id == customer.pk
+        ), "Integrity error: StripeSubscription Customer does not match incoming subscription update customer_id"
+        # Share the Customer instance so sync_to_customer updates it in place.
+        subscription.customer = customer
+
+    # Sync the Customer with the StripeSubscription.
+
+    # If a Customer somehow erroneously has multiple StripeSubscriptions,
+    # prefer the active one, followed by past_due. If there are still multiple,
+    # take the latest created one. That's what this equality check does because
+    # of how customer.subscription the property is defined.
+    # customer.subscription runs a query, so only evaluate it once.
+    customer_subscription = customer.subscription
+    logger.debug(
+        "StripeEvent.id=%s comparing subscription.id=%s and customer.subscription.id=%s",
+        event.id,
+        subscription,
+        customer_subscription,
+    )
+    if subscription == customer_subscription:
+        logger.debug("StripeEvent.id=%s syncing the subcription to customer", event.id)
+        # sync_to_customer writes with a single UPDATE and keeps the in-memory
+        # Customer current, so nothing needs to be reloaded.
+        subscription.sync_to_customer()
+
+        # If payment method has changed and the subscription is paid_due, retry payment.
+        pm_change = (
+            payload["data"].get("previous_attributes", {}).get("default_payment_method")
+        )
+        if (
+            subscription.status
+            in (
+                _SS.INCOMPLETE,
+                _SS.PAST_DUE,
+            )
+            and pm_change
+        ):
+            # Redeliveries of the same Stripe Event share the key, so Stripe only
+            # attempts the payment once per payment method change.
+            services.stripe_retry_latest_invoice(
+                customer.customer_id,
+                idempotency_key=f"retry-invoice-{event.event_id}",
+            )
+
+    return _ES.PROCESSED
+
+
+# Event handlers keyed by the event type without its trailing action, e.g.,
+# customer.subscription.created and customer.subscription.deleted are both handled by
+# the customer.subscription handler. Events without a handler are ignored.
+_HANDLERS = {
+    "customer.subscription": _handle_subscription_event,
+}
+
+
+def get_event_handler(payload_type):
+    """Return the handler for a Stripe Event type, or None if the type is ignored."""
+    return _HANDLERS.get(payload_type.rpartition(".")[0])
+
+
+@shared_task
 def process_stripe_event(event_id, verify_signature=True, check_created=True):
     """Handler for Stripe Events"""
-    logger.info(f"StripeEvent.id={event_id} process_stripe_event task started")
-    event = models.StripeEvent.objects.get(pk=event_id)
+    logger.info("StripeEvent.id=%s process_stripe_event task started", event_id)
+    # Mark the event as pending without instantiating and saving the model. The terminal
+    # status is written once when processing finishes.
+    models.StripeEvent.objects.filter(pk=event_id, status=_ES.NEW).update(
+        status=_ES.PENDING
+    )
     try:
-        event.status = models.StripeEvent.Status.PENDING
-        event.save()
+        # The linked User and Customer come along in the same query.
+        event = models.StripeEvent.objects.select_related("user__customer").get(
+            pk=event_id
+        )
+        # Deliveries are at least once, so duplicates are expected.
+        if event.status in _TERMINAL:
+            logger.info(
+                "StripeEvent.id=%s already in terminal status=%s. Skipping.",
+                event_id,
+                event.status,
+            )
+            return
 
         if verify_signature and settings.STRIPE_WH_SECRET:
             services.stripe_check_webhook_signature(event)
 
-        payload = json.loads(event.body)
-        data_object = payload["data"]["object"]
-
-        # If the payload_type is customer.subscription.*,
-        # create or update the appropriate StripeSubscription.
-        if event.payload_type.startswith("customer.subscription."):
-            # Extract the relevant attributes from the event payload
-            id = data_object["id"]
-            customer_id = data_object["customer"]
-            current_period_end = data_object["current_period_end"]
-            price_id = data_object["items"]["data"][0]["price"]["id"]
-            cancel_at_period_end = data_object["cancel_at_period_end"]
-            created = data_object["created"]
-            status = data_object["status"]
-
-            # Link Customer/User to Event
-            try:
-                customer = link_user_to_event(event, customer_id)
-            except models.Customer.DoesNotExist:
-                # If a user is being hard deleted so the subscription is immediately canceled,
-                # this will happen, so we need to be ok with a user not existing in that case.
-                if status == "canceled":
-                    logger.warning(
-                        f"StripeEvent.id={event.id} could not locate a user who may have been hard deleted."
-                    )
-                    event.status = models.StripeEvent.Status.PROCESSED
-                    event.save()
-                    return
-                else:
-                    raise
-
-            # Ensure this Event is the latest one, i.e., Events haven't
-            # arrived out of order.
-            if check_created and (
-                models.StripeEvent.objects.filter(
-                    user=customer.user, created__gte=event.created
-                )
-                .exclude(pk=event_id)
-                .exists()
-            ):
-                logger.warning(
-                    f"StripeEvent.id={event.id} processed out of order. Ignoring."
-                )
-                event.status = models.StripeEvent.Status.IGNORED
-                event.save()
-                return
-
-            # Create or update StripeSubscription
-            subscription = models.StripeSubscription.objects.filter(id=id).first()
-            if not subscription:
-                logger.info(
-                    f"StripeEvent.id={event_id} no StripeSubscription found, creating."
-                )
-                subscription = models.StripeSubscription(id=id)
+        # Link the User before the transaction so an event that errors stays attached to
+        # its User, and so a Stripe Customer lookup doesn't run under the row lock.
+        handler = get_event_handler(event.payload_type)
+        if handler is not None:
+            customer = _link_event(event, event.payload)
 
-            subscription.current_period_end = dt.fromtimestamp(
-                current_period_end, tz=timezone.utc
+        # All of the handler's writes are committed together, and the row lock
+        # serializes concurrent deliveries of the same event.
+        with transaction.atomic():
+            status = (
+                models.StripeEvent.objects.select_for_update()
+                .values_list("status", flat=True)
+                .get(pk=event_id)
             )
-            subscription.price_id = price_id
-            subscription.cancel_at_period_end = cancel_at_period_end
-            subscription.created = dt.fromtimestamp(created, tz=timezone.utc)
-            subscription.status = status
-            subscription.save()
-
-            # Link Customer/User to StripeSubscription
-            if not subscription.customer:
+            if status in _TERMINAL:
                 logger.info(
-                    f"StripeEvent.id={event_id} no customer attached to StripeSubscription, attaching to {customer}."
+                    "StripeEvent.id=%s already in terminal status=%s. Skipping.",
+                    event_id,
+                    status,
                 )
-                subscription.customer = customer
-                subscription.save()
+                return
+
+            if handler is None:
+                event.status = _ES.IGNORED
             else:
-                # Integrity check: if the StripeSubscription already has a customer, it should match
-                # the incoming subscription update.
-                assert (
-                    subscription.customer == customer
-                ), "Integrity error: StripeSubscription Customer does not match incoming subscription update customer_id"
-
-            # Sync the Customer with the StripeSubscription.
-
-            # If a Customer somehow erroneously has multiple StripeSubscriptions,
-            # prefer the active one, followed by past_due. If there are still multiple,
-            # take the latest created one. That's what this equality check does because
-            # of how customer.subscription the property is defined.
-            logger.debug(
-                f"StripeEvent.id={event_id} comparing subscription.id={subscription} and customer.subscription.id={customer.subscription}"
-            )
-            if subscription == customer.subscription:
-                logger.debug(
-                    f"StripeEvent.id={event.id} syncing the subcription to customer"
-                )
-                subscription.sync_to_customer()
-                subscription.refresh_from_db()
-                customer.refresh_from_db()
-
-                # If payment method has changed and the subscription is paid_due, retry payment.
-                pm_change = (
-                    payload["data"]
-                    .get("previous_attributes", {})
-                    .get("default_payment_method")
-                )
-                if (
-                    subscription.status
-                    in (
-                        models.StripeSubscription.Status.INCOMPLETE,
-                        models.StripeSubscription.Status.PAST_DUE,
-                    )
-                    and pm_change
-                ):
-                    services.stripe_retry_latest_invoice(customer.customer_id)
-
-            event.status = models.StripeEvent.Status.PROCESSED
-        else:
-            event.status = models.StripeEvent.Status.IGNORED
+                event.status = handler(event, event.payload, customer, check_created)
+
+            logger.debug("StripeEvent.id=%s Saving StripeEvent", event.id)
+            event.save(update_fields=["status"])
     except Exception as e:
-        logger.exception(f"StripeEvent.id={event.id} in error state")
-        event.status = models.StripeEvent.Status.ERROR
-        event.note = traceback.format_exc()
-    finally:
-        logger.debug(f"StripeEvent.id={event.id} Saving StripeEvent")
-        event.save()
+        logger.exception("StripeEvent.id=%s in error state", event_id)
+        # Recorded outside of the rolled back transaction so the error status persists.
+        # The full traceback is in the log above.
+        models.StripeEvent.objects.filter(pk=event_id).update(
+            status=_ES.ERROR, note=f"{type(e).__qualname__}: {e}"[:1024]
+        )
 
 
-try:
-    from celery import shared_task
+@shared_task
+def process_new_stripe_events(batch_size=500, pending_timeout=600):
+    """Process StripeEvents that have not been picked up yet, oldest first.
+    Meant to be run periodically when BILLING_EVENT_BATCH_PROCESSING is set.
+    Events left pending for more than pending_timeout seconds after they were received,
+    e.g., by a worker that crashed, are picked up again. Reprocessing an event that is
+    still running is harmless since it waits on the row lock and then skips it."""
+    stale = dt.now(timezone.utc) - timedelta(seconds=pending_timeout)
+    event_ids = list(
+        models.StripeEvent.objects.filter(status__in=[_ES.NEW, _ES.PENDING])
+        .filter(Q(status=_ES.NEW) | Q(received_at__lt=stale))
+        .order_by("created", "pk")
+        .values_list("pk", flat=True)[:batch_size]
+    )
+    logger.info("Processing %s new StripeEvents", len(event_ids))
+    for event_id in event_ids:
+        process_stripe_event(event_id)
+    return len(event_ids)
 
-    process_stripe_event = shared_task(process_stripe_event)
-except ImportError:
-    pass
+
+@shared_task
+def sync_stripe_customer(user_id, customer_id):
+    """Sync the Stripe Customer's metadata and email with the User after checkout.
+    Safe to retry since it only writes what differs."""
+    user = get_user_model().objects.get(pk=user_id)
+    return services.stripe_customer_sync_metadata_email(user, customer_id)
@@ -11,52 +11,62 @@ def enable_db_access_for_all_tests(db):
     pass
 
 
+# stripe.Customer, PaymentMethod and Subscription are called from signals and model
+# methods that most tests reach, so they are always mocked. The remaining Stripe APIs are
+# only called from a few views, so tests request those mocks explicitly.
+# Each mock is limited to the attributes of the Stripe API it replaces, so a misspelled
+# Stripe call fails the test instead of silently returning a Mock.
 @pytest.fixture(autouse=True)
-def mock_stripe_customer(monkeypatch):
-    """Fixture to monkeypatch the stripe.Customer.* methods"""
+def mock_stripe(monkeypatch):
+    """Fixture to monkeypatch the stripe.Customer, stripe.PaymentMethod and
+    stripe.Subscription methods with children of a single Mock"""
     mock = Mock()
-    monkeypatch.setattr(stripe, "Customer", mock)
+    for name in ("Customer", "PaymentMethod", "Subscription"):
+        mock.attach_mock(Mock(spec_set=getattr(stripe, name)), name)
+        monkeypatch.setattr(stripe, name, getattr(mock, name))
     return mock
 
 
-@pytest.fixture(autouse=True)
-def mock_stripe_payment_method(monkeypatch):
-    """Fixture to monkeypatch the stripe.PaymentMethod.* methods"""
-    mock = Mock()
-    monkeypatch.setattr(stripe, "PaymentMethod", mock)
-    return mock
+@pytest.fixture
+def mock_stripe_customer(mock_stripe):
+    """The mocked stripe.Customer.* methods"""
+    return mock_stripe.Customer
 
 
-@pytest.fixture(autouse=True)
-def mock_stripe_subscription(monkeypatch):
-    """Fixture to monkeypatch the stripe.Subscription.* methods"""
-    mock = Mock()
-    monkeypatch.setattr(stripe, "Subscription", mock)
-    return mock
+@pytest.fixture
+def mock_stripe_payment_method(mock_stripe):
+    """The mocked stripe.PaymentMethod.* methods"""
+    return mock_stripe.PaymentMethod
 
 
-@pytest.fixture(autouse=True)
+@pytest.fixture
+def mock_stripe_subscription(mock_stripe):
+    """The mocked stripe.Subscription.* methods"""
+    return mock_stripe.Subscription
+
+
+@pytest.fixture
 def mock_stripe_checkout(monkeypatch):
     """Fixture to monkeypatch stripe.checkout.* methods"""
-    mock = Mock()
+    mock = Mock(spec_set=stripe.checkout)
     mock.Session.create.return_value.url = "https://example.net/stripe_checkout/"
     monkeypatch.setattr(stripe, "checkout", mock)
     return mock
 
 
-@pytest.fixture(autouse=True)
+@pytest.fixture
 def mock_stripe_billing_portal(monkeypatch):
     """Fixture to monkeypatch stripe.billing_portal.* methods"""
-    mock = Mock()
+    mock = Mock(spec_set=stripe.billing_portal)
     mock.Session.create.return_value.url = "https://example.net/stripe_billing_portal/"
     monkeypatch.setattr(stripe, "billing_portal", mock)
     return mock
 
 
-@pytest.fixture(autouse=True)
+@pytest.fixture
 def mock_stripe_invoice(monkeypatch):
     """Fixture to monkeypatch stripe.Invoice.* methods"""
-    mock = Mock()
+    mock = Mock(spec_set=stripe.Invoice)
     monkeypatch.setattr(stripe, "Invoice", mock)
     return mock
 
@@ -39,6 +39,10 @@ DATABASES = {
     }
 }
 
+# Keep sessions in cookies so logging in a test client doesn't write to the database.
+SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
+PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+
 TIME_ZONE = "UTC"
 USE_TZ = True
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
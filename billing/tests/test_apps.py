@@ -0,0 +1,16 @@
+import pytest
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+
+from .. import settings
+
+
+def test_missing_settings(monkeypatch):
+    """Every missing required setting is reported, not just the last one"""
+    monkeypatch.setattr(settings, "APPLICATION_NAME", None)
+    monkeypatch.setattr(settings, "CHECKOUT_SUCCESS_URL", None)
+    with pytest.raises(ImproperlyConfigured) as excinfo:
+        apps.get_app_config("billing").ready()
+    assert str(excinfo.value) == (
+        "APPLICATION_NAME, CHECKOUT_SUCCESS_URL must be configured."
+    )
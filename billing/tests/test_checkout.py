@@ -1,9 +1,14 @@
 import pytest
 from datetime import timedelta
-from django.urls import reverse
+from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.utils.functional import lazy
 
-from .. import factories, settings, models
+from .. import factories, settings, models, views
+
+SUCCESS_URL = reverse("billing:checkout_success")
+# The mocked stripe.checkout.Session.retrieve ignores the id, so one is shared by all tests.
+SUCCESS_QUERY_PARAMS = {"session_id": factories.id("sess")}
 
 
 @pytest.fixture
@@ -11,14 +16,24 @@ def session(user, paid_plan, mock_stripe_checkout):
     session = mock_stripe_checkout.Session.retrieve.return_value
     current_period_end = timezone.now() + timedelta(days=30)
     session.client_reference_id = user.id
-    session.subscription.id = "sub_paid"
-    session.subscription.status = "active"
-    session.subscription.current_period_end = current_period_end.timestamp()
-    session.customer.id = factories.id("cus")
+    session.subscription.configure_mock(
+        id="sub_paid",
+        status="active",
+        current_period_end=current_period_end.timestamp(),
+    )
+    session.customer = factories.id("cus")
     session.line_items = {"data": [{"price": {"id": paid_plan.price_id}}]}
     return session
 
 
+@pytest.fixture
+def stripe_customer(user, mock_stripe_customer):
+    """The Stripe Customer retrieved after checkout, matching the User with no metadata."""
+    stripe_customer = mock_stripe_customer.retrieve.return_value
+    stripe_customer.configure_mock(metadata={}, email=user.email)
+    return stripe_customer
+
+
 def test_create_checkout_session_happy(auth_client, paid_plan, mock_stripe_checkout):
     """create_checkout_session creates a Stripe Session
     and redirects to the appropriate URL"""
@@ -32,6 +47,50 @@ def test_create_checkout_session_happy(auth_client, paid_plan, mock_stripe_check
     assert response.url == mock_stripe_checkout.Session.create.return_value.url
 
 
+@pytest.mark.parametrize(
+    "cancel_url,expected",
+    [
+        (reverse_lazy("profile"), "http://testserver/profile/"),
+        (
+            lazy(lambda: "https://example.com/cancel", str)(),
+            "https://example.com/cancel",
+        ),
+    ],
+)
+def test_create_checkout_session_lazy_cancel_url(
+    cancel_url, expected, monkeypatch, auth_client, paid_plan, mock_stripe_checkout
+):
+    """A lazy CHECKOUT_CANCEL_URL is resolved, and made absolute if needed, per request"""
+    monkeypatch.setattr(settings, "CHECKOUT_CANCEL_URL", cancel_url)
+    url = reverse(
+        "billing:create_checkout_session",
+        kwargs={"slug": paid_plan.slug, "pk": paid_plan.id},
+    )
+    auth_client.post(url, {})
+    assert (
+        str(mock_stripe_checkout.Session.create.call_args.kwargs["cancel_url"])
+        == expected
+    )
+
+
+def test_create_checkout_session_idempotent(
+    monkeypatch, auth_client, paid_plan, mock_stripe_checkout
+):
+    """Repeated checkout requests send Stripe the same idempotency key"""
+    # Keep both requests inside one idempotency window.
+    monkeypatch.setattr(views, "_checkout_idempotency_window", lambda: 1)
+    url = reverse(
+        "billing:create_checkout_session",
+        kwargs={"slug": paid_plan.slug, "pk": paid_plan.id},
+    )
+    auth_client.post(url, {})
+    auth_client.post(url, {})
+    assert mock_stripe_checkout.Session.create.call_count == 2
+    first, second = mock_stripe_checkout.Session.create.call_args_list
+    assert first.kwargs["idempotency_key"]
+    assert first.kwargs["idempotency_key"] == second.kwargs["idempotency_key"]
+
+
 def test_create_checkout_session_bad_plan_id(
     auth_client, paid_plan, mock_stripe_checkout
 ):
@@ -89,16 +148,12 @@ def test_nonpublic_plan(auth_client, mock_stripe_checkout):
 
 
 def test_create_subscription_metadata(
-    caplog, auth_client, user, session, mock_stripe_customer
+    caplog, auth_client, session, stripe_customer, mock_stripe_customer
 ):
     """Successful checkout session updates metadata on Stripe Customer"""
-    mock_stripe_customer.retrieve.return_value.metadata = {}
-    mock_stripe_customer.retrieve.return_value.email = user.email
-    url = reverse("billing:checkout_success")
-    query_params = {"session_id": factories.id("sess")}
 
     with caplog.at_level("ERROR"):
-        response = auth_client.get(url, query_params)
+        response = auth_client.get(SUCCESS_URL, SUCCESS_QUERY_PARAMS)
 
     assert 302 == response.status_code
     assert settings.CHECKOUT_SUCCESS_URL == response.url
@@ -111,18 +166,22 @@ def test_create_subscription_metadata(
     "application,logs", [(settings.APPLICATION_NAME, 1), ("bad", 2)]
 )
 def test_create_subscription_bad_metadata(
-    application, logs, caplog, auth_client, session, mock_stripe_customer
+    application,
+    logs,
+    caplog,
+    auth_client,
+    session,
+    stripe_customer,
+    mock_stripe_customer,
 ):
     """Bad metadata does not update the Stripe Customer and logs an error"""
-    mock_stripe_customer.retrieve.return_value.metadata = {
+    stripe_customer.metadata = {
         "user_pk": "bad",
         "application": application,
     }
-    url = reverse("billing:checkout_success")
-    query_params = {"session_id": factories.id("sess")}
 
     with caplog.at_level("ERROR"):
-        response = auth_client.get(url, query_params)
+        response = auth_client.get(SUCCESS_URL, SUCCESS_QUERY_PARAMS)
 
     assert 302 == response.status_code
     assert settings.CHECKOUT_SUCCESS_URL == response.url
@@ -132,16 +191,13 @@ def test_create_subscription_bad_metadata(
 
 
 def test_create_subscription_changed_email(
-    caplog, auth_client, user, session, mock_stripe_customer
+    caplog, auth_client, user, session, stripe_customer, mock_stripe_customer
 ):
     """If a User changes their email during the Checkout process, revert it."""
-    mock_stripe_customer.retrieve.return_value.metadata = {}
-    mock_stripe_customer.retrieve.return_value.email = "new@example.com"
-    url = reverse("billing:checkout_success")
-    query_params = {"session_id": factories.id("sess")}
+    stripe_customer.email = "new@example.com"
 
     with caplog.at_level("ERROR"):
-        response = auth_client.get(url, query_params)
+        response = auth_client.get(SUCCESS_URL, SUCCESS_QUERY_PARAMS)
 
     assert 302 == response.status_code
     assert settings.CHECKOUT_SUCCESS_URL == response.url
@@ -10,8 +10,6 @@ from django.utils import timezone
 
 from .. import models, factories
 
-User = get_user_model()
-
 
 def test_save_user_create_customer():
     """Saving a User without a Customer automatically creates a Customer with the free_default plan.
@@ -19,7 +17,7 @@ def test_save_user_create_customer():
 
     # Not using the UserFactory here to really emphasize that we're saving a User and triggering
     # the signal.
-    user = User.objects.create_user(
+    user = get_user_model().objects.create_user(
         first_name="Firstname",
         last_name="Lastname",
         username="Firstname Lastname",
@@ -62,14 +60,32 @@ def test_save_user_save_customer():
         ),
     ],
 )
-def test_update_user_stripe(field, value, should_call, mock_stripe_customer):
-    """Updating a User's first_name, last_name, or email also updates it in Stripe."""
+@pytest.mark.parametrize("partial", [False, True])
+def test_update_user_stripe(field, value, should_call, partial, mock_stripe_customer):
+    """Updating a User's first_name, last_name, or email also updates it in Stripe,
+    whether the whole User or only that field is saved."""
     user = factories.UserFactory(paying=True)
     setattr(user, field, value)
-    user.save()
+    user.save(update_fields=[field] if partial else None)
     assert mock_stripe_customer.modify.called is should_call
 
 
+def test_update_user_unrelated_fields(mock_stripe_customer):
+    """Saving only fields that aren't synced to Stripe skips the Stripe update."""
+    user = factories.UserFactory(paying=True)
+    user.first_name = factories.fake.first_name()
+    user.save(update_fields=["last_login"])
+    assert mock_stripe_customer.modify.called is False
+
+
+def test_save_user_loads_customer_plan(django_assert_num_queries):
+    """Saving a User loads its Customer and Plan together for the signals to use."""
+    user = get_user_model().objects.get(pk=factories.UserFactory().pk)
+    user.save()
+    with django_assert_num_queries(0):
+        assert user.customer.plan.type == models.Plan.Type.FREE_DEFAULT
+
+
 def test_soft_delete_user_active_subscription(mock_stripe_subscription):
     """Soft deleting a User with an active Stripe subscription cancels the Subscription."""
     user = factories.UserFactory(paying=True)
@@ -107,6 +123,20 @@ def test_no_subscriptions(customer):
     assert customer.subscription is None
 
 
+def test_subscription_prefetched(django_assert_num_queries):
+    """Customer.subscription and Customer.state use prefetched StripeSubscriptions
+    without querying again."""
+    user = factories.UserFactory(paying=True)
+    customer = (
+        models.Customer.objects.select_related("plan")
+        .prefetch_related("stripesubscription_set")
+        .get(user=user)
+    )
+    with django_assert_num_queries(0):
+        assert customer.subscription.status == "active"
+        assert customer.state == "paid.paying"
+
+
 def test_cancel_subscription_immediately(mock_stripe_subscription):
     """Immediately canceling a subscription calls out to Stripe to cancel immediately."""
     user = factories.UserFactory(paying=True)
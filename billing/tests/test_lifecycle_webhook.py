@@ -1,6 +1,7 @@
 """Stripe lifecycle webhook functionality. Webhooks where the user has taken
 some action in Checkout or Portal are found elsewhere."""
 
+import json
 from datetime import timedelta
 from unittest.mock import Mock
 from freezegun import freeze_time
@@ -9,7 +10,9 @@ import pytest
 from django.utils import timezone
 from django.urls import reverse
 
-from .. import models, factories
+from .. import models, factories, settings, tasks
+
+WEBHOOK_URL = reverse("billing:stripe_webhook")
 
 
 @pytest.fixture
@@ -68,30 +71,27 @@ def subscription_event(customer, paid_plan):
 
 def test_create_event(client):
     """Create event"""
-    url = reverse("billing:stripe_webhook")
     payload = {
         "id": "evt_test",
         "object": "event",
         "type": "test",
         "created": timezone.now().timestamp(),
     }
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert response.status_code == 201
     assert 1 == models.StripeEvent.objects.count()
 
 
 def test_bad_json(client):
     """Malformed JSON"""
-    url = reverse("billing:stripe_webhook")
     payload = "bad json"
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert response.status_code == 400
     assert models.StripeEvent.objects.count() == 0
 
 
 def test_unrecognized_type(client):
     """Unrecognized event type"""
-    url = reverse("billing:stripe_webhook")
     payload = {
         "id": "evt_test",
         "object": "event",
@@ -99,8 +99,28 @@ def test_unrecognized_type(client):
         "created": timezone.now().timestamp(),
         "data": {"object": None},
     }
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
+    assert 201 == response.status_code
+    assert (
+        models.StripeEvent.Status.IGNORED == models.StripeEvent.objects.first().status
+    )
+
+
+def test_unrecognized_type_not_queued(client, monkeypatch):
+    """An event type without a handler is recorded as ignored without queuing a task."""
+    mock = Mock()
+    monkeypatch.setattr(tasks, "process_stripe_event", mock)
+    payload = {
+        "id": "evt_test",
+        "object": "event",
+        "type": "invoice.paid",
+        "created": timezone.now().timestamp(),
+        "data": {"object": None},
+    }
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert 201 == response.status_code
+    assert mock.call_count == 0
+    assert mock.delay.call_count == 0
     assert (
         models.StripeEvent.Status.IGNORED == models.StripeEvent.objects.first().status
     )
@@ -110,20 +130,19 @@ def test_subscription_event_new_stripe_subscription(
     customer, client, subscription_event
 ):
     """A Stripe Subscription event payload should correctly create a StripeSubscription."""
-    url = reverse("billing:stripe_webhook")
     event_json = subscription_event()
     customer.stripesubscription_set.all().delete()
     assert 0 == models.StripeSubscription.objects.count()
 
     payload = event_json["payload"]
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert 201 == response.status_code
-    assert 1 == models.StripeEvent.objects.count()
-    event = models.StripeEvent.objects.first()
-    assert models.StripeEvent.Status.PROCESSED == event.status
+    statuses = list(models.StripeEvent.objects.values_list("status", flat=True))
+    assert [models.StripeEvent.Status.PROCESSED] == statuses
 
-    assert 1 == models.StripeSubscription.objects.count()
-    subscription = models.StripeSubscription.objects.first()
+    subscriptions = list(models.StripeSubscription.objects.all())
+    assert 1 == len(subscriptions)
+    subscription = subscriptions[0]
 
     assert subscription.id == event_json["id"]
     assert subscription.customer.customer_id == event_json["customer_id"]
@@ -138,7 +157,6 @@ def test_subscription_event_new_stripe_subscription(
 
 def test_subscription_event_update_stripe_subscription(client, subscription_event):
     """A Stripe Subscription event payload should correctly update a StripeSubscription."""
-    url = reverse("billing:stripe_webhook")
     event_attributes = {
         "current_period_end": (timezone.now() + timedelta(days=45)).timestamp(),
         # "price_id": "new_price" -- not available until we can upgrade plans
@@ -152,14 +170,14 @@ def test_subscription_event_update_stripe_subscription(client, subscription_even
         assert event_json[k] == v
 
     payload = event_json["payload"]
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert 201 == response.status_code
-    assert 1 == models.StripeEvent.objects.count()
-    event = models.StripeEvent.objects.first()
-    assert models.StripeEvent.Status.PROCESSED == event.status
+    statuses = list(models.StripeEvent.objects.values_list("status", flat=True))
+    assert [models.StripeEvent.Status.PROCESSED] == statuses
 
-    assert 1 == models.StripeSubscription.objects.count()
-    subscription = models.StripeSubscription.objects.first()
+    subscriptions = list(models.StripeSubscription.objects.all())
+    assert 1 == len(subscriptions)
+    subscription = subscriptions[0]
 
     assert subscription.id == event_json["id"]
     assert subscription.customer.customer_id == event_json["customer_id"]
@@ -174,9 +192,8 @@ def test_subscription_event_update_stripe_subscription(client, subscription_even
 
 def test_link_event_to_user(client, customer, subscription_event):
     """A Stripe Event should be connected to a User."""
-    url = reverse("billing:stripe_webhook")
     payload = subscription_event()["payload"]
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert response.status_code == 201
     event = models.StripeEvent.objects.first()
     assert event.user == customer.user
@@ -184,11 +201,10 @@ def test_link_event_to_user(client, customer, subscription_event):
 
 def test_user_not_found(client, mock_stripe_customer, subscription_event):
     """If a user can't be found, error."""
-    url = reverse("billing:stripe_webhook")
     mock_stripe_customer.retrieve.return_value.email = "notfound@example.com"
     payload = subscription_event(id="sub_new", customer_id="cus_new")["payload"]
 
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert response.status_code == 201
     event = models.StripeEvent.objects.first()
     assert event.status == models.StripeEvent.Status.ERROR
@@ -199,14 +215,33 @@ def test_user_not_found(client, mock_stripe_customer, subscription_event):
 def test_persist_customer_id(user, client, mock_stripe_customer, subscription_event):
     """A Customer without a Stripe customer_id gets it set on the first subscription event."""
     mock_stripe_customer.retrieve.return_value.email = user.email
-    url = reverse("billing:stripe_webhook")
     event_json = subscription_event(id="sub_new", customer_id="cus_new")
     assert user.customer.customer_id is None
 
     payload = event_json["payload"]
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert 201 == response.status_code
-    user.customer.refresh_from_db()
+    user.customer.refresh_from_db(fields=["customer_id"])
+    assert user.customer.customer_id == "cus_new"
+
+
+def test_linked_event_uses_user(user, mock_stripe_customer, subscription_event):
+    """An event already linked to a User, e.g., a replay, uses that User's Customer
+    without looking it up on Stripe."""
+    payload = subscription_event(id="sub_new", customer_id="cus_new")["payload"]
+    event = models.StripeEvent.objects.create(
+        event_id=payload["id"],
+        payload_type=payload["type"],
+        headers={},
+        body=json.dumps(payload),
+        created=timezone.now(),
+        user=user,
+    )
+    tasks.process_stripe_event(event.id, verify_signature=False)
+    event.refresh_from_db(fields=["status"])
+    assert event.status == models.StripeEvent.Status.PROCESSED
+    assert mock_stripe_customer.retrieve.call_count == 0
+    user.customer.refresh_from_db(fields=["customer_id"])
     assert user.customer.customer_id == "cus_new"
 
 
@@ -215,43 +250,61 @@ def test_subscription_customer_mismatch(
 ):
     """If a subscription already belongs to a different customer in the database than
     the customer_id reported on the event, something is wrong.
-    This could happen if someone changes who the StripeSubscription instance is connected to in the admin."""
+    This could happen if someone changes who the StripeSubscription instance is connected to in the admin.
+    """
     mock_stripe_customer.retrieve.return_value.email = user.email
-    url = reverse("billing:stripe_webhook")
     payload = subscription_event(customer_id="cus_different")["payload"]
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert 201 == response.status_code
     event = models.StripeEvent.objects.first()
     assert event.status == models.StripeEvent.Status.ERROR
     assert "Integrity error" in event.note
+    # The link to the User survives the rolled back handler.
+    assert event.user == user
 
 
 def test_multiple_subscriptions_sync(client, subscription_event, monkeypatch):
     """If a customer has multiple subscriptions, the sync function is only called for the correct one."""
     mock = Mock()
     monkeypatch.setattr(models.StripeSubscription, "sync_to_customer", mock)
-    url = reverse("billing:stripe_webhook")
 
     payload = subscription_event(id="sub_different", status="past_due")["payload"]
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert 201 == response.status_code
     assert mock.call_count == 0
 
     payload = subscription_event(status="past_due")["payload"]
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert 201 == response.status_code
     assert mock.call_count == 1
 
 
+@pytest.mark.parametrize("status", ["processed", "ignored", "error"])
+def test_duplicate_delivery(client, subscription_event, monkeypatch, status):
+    """Processing an event that already reached a terminal status does nothing."""
+    payload = subscription_event()["payload"]
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
+    assert 201 == response.status_code
+    event = models.StripeEvent.objects.first()
+    event.status = status
+    event.save()
+
+    mock = Mock()
+    monkeypatch.setattr(models.StripeSubscription, "sync_to_customer", mock)
+    tasks.process_stripe_event(event.id)
+    assert mock.call_count == 0
+    event.refresh_from_db(fields=["status"])
+    assert event.status == status
+
+
 def test_payment_update_active(
     client, customer, subscription_event, mock_stripe_invoice
 ):
     """An update to a Subscription's payment method does not do anything if the Subscription is
     active."""
-    url = reverse("billing:stripe_webhook")
     payload = subscription_event()["payload"]
     payload["data"]["previous_attributes"] = {"default_payment_method": "pm_new"}
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert response.status_code == 201
     event = models.StripeEvent.objects.first()
     assert event.status == models.StripeEvent.Status.PROCESSED
@@ -268,25 +321,27 @@ def test_payment_update_and_retry(
     mock_stripe_invoice.list.return_value = {
         "data": [{"status": "open", "id": "inv_123"}]
     }
-    url = reverse("billing:stripe_webhook")
 
     payload = subscription_event(status=status)["payload"]
     payload["data"]["previous_attributes"] = {"default_payment_method": "pm_new"}
 
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert response.status_code == 201
     event = models.StripeEvent.objects.first()
     assert event.status == models.StripeEvent.Status.PROCESSED
     assert event.user.customer == customer
     assert mock_stripe_invoice.list.call_count == 1
     assert mock_stripe_invoice.pay.call_count == 1
+    assert (
+        mock_stripe_invoice.pay.call_args.kwargs["idempotency_key"]
+        == f"retry-invoice-{payload['id']}"
+    )
 
 
 def test_incomplete_expired_cycle(client, user, subscription_event):
     """A StripeSubscription that transitions from incomplete to incomplete_expired should not error."""
     # This is a bugfix that results from ignoring deleted subscriptions when the customer is not on a
     # paid plan. Customers are, of course, not normally on paid plans when their status is incomplete.
-    url = reverse("billing:stripe_webhook")
 
     customer = user.customer
     factories.StripeSubscriptionFactory(
@@ -299,7 +354,7 @@ def test_incomplete_expired_cycle(client, user, subscription_event):
         current_period_end=(timezone.now() + timedelta(days=30)).timestamp(),
     )["payload"]
 
-    response = client.post(url, payload, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
     assert response.status_code == 201
     event = models.StripeEvent.objects.first()
     assert event.status == models.StripeEvent.Status.PROCESSED
@@ -311,7 +366,6 @@ def test_misordered_event(client, user, mock_stripe_customer, subscription_event
     is ignored."""
     # Trying to deal with the case where subscription.created appears after
     # subscription.updated and the Customer gets locked into an incomplete state.
-    url = reverse("billing:stripe_webhook")
 
     customer = user.customer
     customer.customer_id = None
@@ -338,9 +392,9 @@ def test_misordered_event(client, user, mock_stripe_customer, subscription_event
         created=now,
     )["payload"]
 
-    response = client.post(url, payload1, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload1, content_type="application/json")
     assert response.status_code == 201
-    response = client.post(url, payload2, content_type="application/json")
+    response = client.post(WEBHOOK_URL, payload2, content_type="application/json")
     assert response.status_code == 201
 
     events = models.StripeEvent.objects.all()
@@ -349,3 +403,41 @@ def test_misordered_event(client, user, mock_stripe_customer, subscription_event
     customer.refresh_from_db()
     assert customer.customer_id == "cus_new"
     assert customer.state == "paid.paying"
+
+
+def test_batch_processing(client, customer, subscription_event, monkeypatch):
+    """With batch processing enabled, webhooks are only stored and the periodic task
+    processes them."""
+    monkeypatch.setattr(settings, "EVENT_BATCH_PROCESSING", True)
+    payload = subscription_event(status="past_due")["payload"]
+    response = client.post(WEBHOOK_URL, payload, content_type="application/json")
+    assert response.status_code == 201
+    event = models.StripeEvent.objects.first()
+    assert event.status == models.StripeEvent.Status.NEW
+
+    assert tasks.process_new_stripe_events() == 1
+    event.refresh_from_db(fields=["status"])
+    assert event.status == models.StripeEvent.Status.PROCESSED
+    assert customer.subscription.status == "past_due"
+    assert tasks.process_new_stripe_events() == 0
+
+
+def test_batch_processing_stale_pending(
+    client, customer, subscription_event, monkeypatch
+):
+    """The periodic task picks up events left pending for too long, e.g., by a worker
+    that crashed, but not ones that may still be running."""
+    monkeypatch.setattr(settings, "EVENT_BATCH_PROCESSING", True)
+    payload = subscription_event(status="past_due")["payload"]
+    client.post(WEBHOOK_URL, payload, content_type="application/json")
+    models.StripeEvent.objects.update(status=models.StripeEvent.Status.PENDING)
+
+    assert tasks.process_new_stripe_events() == 0
+
+    models.StripeEvent.objects.update(
+        received_at=timezone.now() - timedelta(minutes=11)
+    )
+    assert tasks.process_new_stripe_events() == 1
+    event = models.StripeEvent.objects.get()
+    assert event.status == models.StripeEvent.Status.PROCESSED
+    assert customer.subscription.status == "past_due"
@@ -1,7 +1,9 @@
+from datetime import datetime, timezone
 import pytest
 from pytest_django.asserts import assertTemplateUsed
 from django.urls import reverse
 from ..models import Customer
+from ..mixins import BillingMixin
 
 
 @pytest.mark.parametrize(
@@ -25,3 +27,18 @@ def test_billing_mixin(auth_client, monkeypatch, state, paid_plan):
     url = reverse("profile")
     response = auth_client.get(url)
     assertTemplateUsed(response, "profile.html")
+
+
+def test_state_note(settings, monkeypatch):
+    """The state note includes the current period end in the local timezone, and uses
+    the Customer's state unless one is passed in"""
+    settings.TIME_ZONE = "UTC"
+    customer = Customer(
+        current_period_end=datetime(2022, 3, 4, 12, tzinfo=timezone.utc)
+    )
+    monkeypatch.setattr(Customer, "state", "paid.paying")
+    assert BillingMixin.state_note(customer) == "Subscription renews on Mar 04, 2022."
+    assert BillingMixin.state_note(customer, "free_default.new") == ""
+    assert BillingMixin.state_note(customer, "unknown").startswith(
+        "There is an issue with your subscription."
+    )
@@ -9,27 +9,39 @@ from django.core.exceptions import ObjectDoesNotExist
 from .. import factories, models
 
 
-@pytest.fixture
-def paid_plan():
-    factories.PlanLimitFactory(
-        plan__paid=True,
-        value=1,
-        limit__name="Limit 1",
-        limit__default=99,
-    )
-    factories.PlanLimitFactory(
-        plan__paid=True,
-        value=2,
-        limit__name="Limit 2",
-        limit__default=98,
-    )
-    factories.LimitFactory(name="Limit 3", default=97)
+@pytest.fixture(scope="module")
+def paid_plan(django_db_setup, django_db_blocker):
+    """The Plans, Limits and paying Customer are only read by the tests, so they are
+    created once for the module. Whatever a test changes is rolled back with it."""
+    with django_db_blocker.unblock():
+        plan = factories.PlanFactory(paid=True)
+        limits = models.Limit.objects.bulk_create(
+            [
+                factories.LimitFactory.build(name="Limit 1", default=99),
+                factories.LimitFactory.build(name="Limit 2", default=98),
+                factories.LimitFactory.build(name="Limit 3", default=97),
+            ]
+        )
+        models.PlanLimit.objects.bulk_create(
+            [
+                factories.PlanLimitFactory.build(plan=plan, limit=limits[0], value=1),
+                factories.PlanLimitFactory.build(plan=plan, limit=limits[1], value=2),
+            ]
+        )
+        user = factories.UserFactory(paying=True)
+    yield user.customer.pk
+    with django_db_blocker.unblock():
+        # Without a subscription, deleting the User doesn't cancel anything in Stripe.
+        models.StripeSubscription.objects.all().delete()
+        user.delete()
+        models.Plan.objects.all().delete()
+        models.Limit.objects.all().delete()
 
 
 @pytest.fixture
 def customer(paid_plan):
-    user = factories.UserFactory(paying=True)
-    return user.customer
+    # Loaded per test since tests modify it.
+    return models.Customer.objects.get(pk=paid_plan)
 
 
 @pytest.mark.django_db
@@ -41,6 +53,34 @@ def test_get_limit(customer):
     assert value == 2
 
 
+@pytest.mark.django_db
+def test_get_limit_prefetched(customer, django_assert_num_queries):
+    """Customer.get_limit uses prefetched PlanLimits rather than querying for them."""
+    customer = (
+        models.Customer.objects.select_related("plan")
+        .prefetch_related("plan__planlimit_set__limit")
+        .get(pk=customer.pk)
+    )
+    with django_assert_num_queries(0):
+        assert customer.get_limit("Limit 1") == 1
+    # Only the Limit default needs a query.
+    with django_assert_num_queries(1):
+        assert customer.get_limit("Limit 3") == 97
+
+
+@pytest.mark.django_db
+def test_get_limit_partially_prefetched(customer, django_assert_num_queries):
+    """Customer.get_limit queries for the PlanLimit once if the PlanLimits were
+    prefetched without their Limits."""
+    customer = (
+        models.Customer.objects.select_related("plan")
+        .prefetch_related("plan__planlimit_set")
+        .get(pk=customer.pk)
+    )
+    with django_assert_num_queries(1):
+        assert customer.get_limit("Limit 2") == 2
+
+
 @pytest.mark.django_db
 def test_get_limit_default(customer):
     """Customer.get_limit returns the Limit default if the Plan does not have have that PlanLimit."""
@@ -3,6 +3,8 @@ from django.urls import reverse
 
 from .. import factories, models
 
+PORTAL_URL = reverse("billing:create_portal_session")
+
 
 @pytest.fixture
 def user():
@@ -16,8 +18,7 @@ def user():
 
 def test_portal_happy(auth_client, mock_stripe_billing_portal):
     """A Customer can create a Stripe Portal session"""
-    url = reverse("billing:create_portal_session")
-    response = auth_client.post(url)
+    response = auth_client.post(PORTAL_URL)
     assert mock_stripe_billing_portal.Session.create.call_count == 1
     assert response.status_code == 302
     # URL for the Portal itself
@@ -33,9 +34,18 @@ def test_portal_wrong_state(auth_client, customer, mock_stripe_billing_portal):
     assert customer.state == "free_default.new"
 
     payload = {"return_url": "http://example.com/return_url"}
-    url = reverse("billing:create_portal_session")
-    response = auth_client.post(url, payload)
+    response = auth_client.post(PORTAL_URL, payload)
     assert mock_stripe_billing_portal.Session.create.call_count == 0
     assert response.status_code == 302
     # URL on the app since it never makes it to the Portal session.
     assert response.url == "http://example.com/return_url"
+
+
+def test_portal_queries(
+    auth_client, mock_stripe_billing_portal, django_assert_num_queries
+):
+    """Creating a Stripe Portal session loads the User, then the Customer with its
+    Plan and StripeSubscriptions, and nothing else"""
+    with django_assert_num_queries(3):
+        response = auth_client.post(PORTAL_URL)
+    assert response.status_code == 302
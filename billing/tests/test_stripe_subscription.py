@@ -2,14 +2,11 @@
 
 import pytest
 
-from django.contrib.auth import get_user_model
 from django.utils import timezone
 from datetime import timedelta
 
 from .. import models, factories
 
-User = get_user_model()
-
 
 @pytest.mark.parametrize(
     "status", ["incomplete", "incomplete_expired", "active", "past_due", "canceled"]
@@ -1,5 +1,7 @@
+import hashlib
 import json
 import logging
+import time
 from datetime import datetime as dt
 from django.utils import timezone
 from urllib.parse import urlparse
@@ -15,11 +17,22 @@ from django.http import JsonResponse
 
 import stripe
 
-from . import models, settings, services, tasks
+from . import models, settings, tasks
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
+# Keys that every Stripe Event payload must have.
+REQUIRED_EVENT_KEYS = frozenset(("id", "type", "created"))
+
+# Seconds during which repeated identical checkout requests share a Checkout Session.
+CHECKOUT_IDEMPOTENCY_WINDOW = 600
+
+
+def _checkout_idempotency_window():
+    """The idempotency window the current time falls in."""
+    return int(time.time()) // CHECKOUT_IDEMPOTENCY_WINDOW
+
 
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -29,12 +42,7 @@ def stripe_webhook_view(request):
     except json.decoder.JSONDecodeError as e:
         return JsonResponse({"detail": "Invalid payload"}, status=400)
 
-    if (
-        type(payload) != dict
-        or "type" not in payload
-        or "id" not in payload
-        or "created" not in payload
-    ):
+    if type(payload) != dict or not REQUIRED_EVENT_KEYS <= payload.keys():
         return JsonResponse({"detail": "Invalid payload"}, status=400)
 
     headers = {}
@@ -43,21 +51,27 @@ def stripe_webhook_view(request):
         if isinstance(value, str):
             headers[key] = value
 
+    # Events that no handler acts on are recorded as ignored without queuing a task.
+    handled = tasks.get_event_handler(payload["type"]) is not None
     event = models.StripeEvent.objects.create(
         event_id=payload["id"],
         payload_type=payload["type"],
         created=dt.fromtimestamp(payload["created"], tz=timezone.utc),
         body=request.body.decode("utf-8"),
         headers=headers,
-        status=models.StripeEvent.Status.NEW,
+        status=models.StripeEvent.Status.NEW
+        if handled
+        else models.StripeEvent.Status.IGNORED,
     )
     logger.info(
         f"StripeEvent.id={event.id} StripeEvent.payload_type={event.payload_type} received"
     )
-    if hasattr(tasks, "shared_task"):
-        tasks.process_stripe_event.delay(event.id)
-    else:
-        tasks.process_stripe_event(event.id)
+    # With batch processing, the periodic process_new_stripe_events task picks it up.
+    if handled and not settings.EVENT_BATCH_PROCESSING:
+        if tasks.HAS_CELERY:
+            tasks.process_stripe_event.delay(event.id)
+        else:
+            tasks.process_stripe_event(event.id)
 
     return JsonResponse({"detail": "Created"}, status=201)
 
@@ -65,10 +79,15 @@ def stripe_webhook_view(request):
 class CreateCheckoutSessionView(LoginRequiredMixin, View):
     def post(self, request, slug, pk):
         # Redirect to cancel url if no price id or if price id not in Plan
-        plan = models.Plan.objects.filter(
-            id=pk,
-            type__in=[models.Plan.Type.PAID_PUBLIC, models.Plan.Type.PAID_PRIVATE],
-        ).first()
+        # Only the slug, which comes from the name, and the price_id are used.
+        plan = (
+            models.Plan.objects.filter(
+                id=pk,
+                type__in=[models.Plan.Type.PAID_PUBLIC, models.Plan.Type.PAID_PRIVATE],
+            )
+            .only("name", "price_id")
+            .first()
+        )
         if not plan:
             logger.error(f"In CreateCheckoutSessionView, invalid plan id={pk}")
             messages.error(request, "Invalid billing plan.")
@@ -84,7 +103,12 @@ class CreateCheckoutSessionView(LoginRequiredMixin, View):
 
         # User must not have an active billing plan
         # If a user is trying to switch between paid plans, this is the wrong endpoint.
-        customer = request.user.customer
+        # Customer.state looks at the plan and subscriptions many times, so load them up front.
+        customer = (
+            models.Customer.objects.select_related("plan")
+            .prefetch_related("stripesubscription_set")
+            .get(user=request.user)
+        )
         if customer.state not in (
             "free_default.new",
             "free_private.expired",
@@ -110,8 +134,7 @@ class CreateCheckoutSessionView(LoginRequiredMixin, View):
         else:
             customer_email = request.user.email
 
-        # Create Session if all is well.
-        session = stripe.checkout.Session.create(
+        session_params = dict(
             success_url=success_url,
             cancel_url=cancel_url,
             payment_method_types=["card"],
@@ -122,6 +145,21 @@ class CreateCheckoutSessionView(LoginRequiredMixin, View):
             customer=customer.customer_id,
             customer_email=customer_email,
         )
+        # A double submitted form gets the same Session back from Stripe rather than
+        # creating a second one. The key covers the parameters so Stripe doesn't reject
+        # a request that differs, and it rolls over after the idempotency window.
+        idempotency_key = hashlib.sha256(
+            json.dumps(
+                [session_params, _checkout_idempotency_window()],
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()
+
+        # Create Session if all is well.
+        session = stripe.checkout.Session.create(
+            idempotency_key=idempotency_key, **session_params
+        )
         return redirect(session.url, permanent=False)
 
 
@@ -133,7 +171,7 @@ class CheckoutSuccessView(LoginRequiredMixin, View):
             return redirect(settings.CHECKOUT_CANCEL_URL)
 
         try:
-            session = stripe.checkout.Session.retrieve(session_id, expand=["customer"])
+            session = stripe.checkout.Session.retrieve(session_id)
         except stripe.error.InvalidRequestError as e:
             messages.error(request, "Invalid session id provided.")
             return redirect(settings.CHECKOUT_CANCEL_URL)
@@ -149,8 +187,8 @@ class CheckoutSuccessView(LoginRequiredMixin, View):
             return redirect(settings.CHECKOUT_CANCEL_URL)
 
         customer = request.user.customer
-        if customer.customer_id and (session.customer.id != customer.customer_id):
-            msg = f"customer_id={customer.customer_id} on user.customer does not match session.customer.id={session.customer.id}"
+        if customer.customer_id and (session.customer != customer.customer_id):
+            msg = f"customer_id={customer.customer_id} on user.customer does not match session.customer={session.customer}"
             logger.error(msg)
             messages.error(
                 request,
@@ -159,8 +197,11 @@ class CheckoutSuccessView(LoginRequiredMixin, View):
             return redirect(settings.CHECKOUT_CANCEL_URL)
 
         # If users change their email on the checkout page, this will change it back
-        # on the Stripe Customer.
-        services.stripe_customer_sync_metadata_email(request.user, session.customer.id)
+        # on the Stripe Customer. The user doesn't wait on it when Celery is available.
+        if tasks.HAS_CELERY:
+            tasks.sync_stripe_customer.delay(request.user.pk, session.customer)
+        else:
+            tasks.sync_stripe_customer(request.user.pk, session.customer)
         messages.success(request, "Successfully subscribed!")
 
         return redirect(settings.CHECKOUT_SUCCESS_URL)
@@ -175,7 +216,12 @@ class CreatePortalView(LoginRequiredMixin, View):
             return_url = f"{request.scheme}://{request.get_host()}{return_url}"
 
         # User should be able to access the Portal.
-        customer = request.user.customer
+        # Customer.state looks at the plan and subscriptions many times, so load them up front.
+        customer = (
+            models.Customer.objects.select_related("plan")
+            .prefetch_related("stripesubscription_set")
+            .get(user=request.user)
+        )
         if customer.state not in (
             "free_default.past_due.requires_payment_method",
             "free_default.incomplete.requires_payment_method",
@@ -189,10 +235,8 @@ class CreatePortalView(LoginRequiredMixin, View):
             messages.error(request, "User does not have access.")
             return redirect(return_url)
 
-        customer_id = request.user.customer.customer_id
-
         session = stripe.billing_portal.Session.create(
-            customer=customer_id,
+            customer=customer.customer_id,
             return_url=return_url,
         )
 